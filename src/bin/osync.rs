@@ -1,9 +1,12 @@
+use std::error::Error;
 use std::process;
 
 use clap::{crate_authors, crate_version, App, AppSettings, Arg};
 use url::Url;
 
 use osync::index::Index;
+#[cfg(feature = "sftp")]
+use osync::sftp::SftpSync;
 use osync::sync::{FtpSync, Sync};
 
 fn main() {
@@ -27,12 +30,26 @@ fn main() {
                 .long("assume-directories")
                 .help("Use the local index to determinate existing directories"),
         )
+        .arg(
+            Arg::with_name("parallel")
+                .long("parallel")
+                .value_name("N")
+                .default_value("4")
+                .help("The number of files to upload simultaneously"),
+        )
         .setting(AppSettings::ArgRequiredElseHelp)
         .get_matches();
 
     let src = matches.value_of("src").unwrap();
     let dst = matches.value_of("dst").map(|v| Url::parse(v).unwrap());
     let assume_directories = matches.is_present("assume-directories");
+    let parallel = match matches.value_of("parallel").unwrap().parse::<usize>() {
+        Ok(parallel) => parallel,
+        Err(e) => {
+            eprintln!("invalid value for --parallel: {}", e);
+            process::exit(1);
+        }
+    };
 
     // Read previous index (if any)
     let mut previous_index = match Index::load(src) {
@@ -45,7 +62,7 @@ fn main() {
     println!("Index of {} files loaded", previous_index.len());
 
     // Compute current index
-    let current_index = match Index::compute(src) {
+    let current_index = match Index::compute(src, &previous_index) {
         Ok((index, ignored_files)) => {
             println!("({} files ignored)", ignored_files);
             index
@@ -58,10 +75,18 @@ fn main() {
     println!("Index of {} files computed", current_index.len());
 
     // Synchronize the files
-    let mut synchronizer = match FtpSync::new(&dst) {
+    let synchronizer: Result<Box<dyn Sync>, Box<dyn Error>> = match dst.as_ref().map(Url::scheme) {
+        None | Some("ftp") => FtpSync::new(&dst, parallel).map(|s| Box::new(s) as Box<dyn Sync>),
+        #[cfg(feature = "sftp")]
+        Some("sftp") => {
+            SftpSync::new(dst.as_ref().unwrap(), parallel).map(|s| Box::new(s) as Box<dyn Sync>)
+        }
+        Some(scheme) => Err(format!("unsupported scheme: {}", scheme).into()),
+    };
+    let mut synchronizer = match synchronizer {
         Ok(s) => s,
         Err(e) => {
-            eprintln!("error while connecting to the server: {}", e);
+            eprintln!("error while setting up the synchronization: {}", e);
             process::exit(1);
         }
     };
@@ -1,19 +1,98 @@
 use std::collections::HashMap;
+use std::convert::TryFrom;
 use std::error::Error;
 use std::fs;
-use std::fs::File;
-use std::io::{BufRead, BufReader, Write};
-use std::path::{Path, PathBuf};
-
+use std::fs::{File, Metadata};
+use std::io::{self, BufRead, BufReader, BufWriter, ErrorKind, Read};
+use std::path::{Path, PathBuf, MAIN_SEPARATOR};
+use std::sync::atomic::{AtomicBool, Ordering};
+use std::sync::Mutex;
+use std::thread;
+use std::time::UNIX_EPOCH;
+
+use serde::{Deserialize, Serialize};
 use sha1::Digest;
 use walkdir::WalkDir;
 
 const INDEX_FILE: &str = ".osync";
+/// The index is written to this file first, then renamed.
+const INDEX_TEMP_FILE: &str = ".osync.tmp";
 const IGNORE_FILE: &str = ".osyncignore";
+pub(crate) const DIRECTORY_CACHE_FILE: &str = ".osyncdirs";
+
+/// Version of the index format, saved along with the entries.
+const INDEX_VERSION: u8 = 1;
+
+/// The index is saved as a msgpack array of two elements (version, entries):
+/// this first byte cannot start an (older) plain text index since it is not valid UTF-8.
+const INDEX_HEADER: u8 = 0x92;
+
+/// The index is saved compressed using zstd, at this level.
+const INDEX_COMPRESSION_LEVEL: i32 = 3;
+
+/// Magic number of zstd frames, used to tell compressed indexes from (older) plain text ones.
+const ZSTD_MAGIC: [u8; 4] = [0x28, 0xb5, 0x2f, 0xfd];
+
+/// Size of the chunks read from the files when computing their checksum.
+const CHECKSUM_BUFFER_SIZE: usize = 1024 * 1024;
+
+/// Prefix of the checksums computed using xxh3 (SHA-1 ones have none).
+#[cfg(feature = "xxhash")]
+const XXH3_PREFIX: &str = "xxh3-";
+
+/// The algorithm used to compute the checksum of new and changed files.
+#[cfg(feature = "xxhash")]
+const DEFAULT_ALGORITHM: Algorithm = Algorithm::Xxh3;
+#[cfg(not(feature = "xxhash"))]
+const DEFAULT_ALGORITHM: Algorithm = Algorithm::Sha1;
+
+/// The algorithms available to compute the checksums.
+/// xxh3 is much faster than SHA-1 and is enough to detect changes,
+/// but requires the `xxhash` feature.
+#[derive(Clone, Copy, Debug, PartialEq)]
+enum Algorithm {
+    // only used by default when the xxhash feature is disabled
+    #[cfg_attr(feature = "xxhash", allow(dead_code))]
+    Sha1,
+    #[cfg(feature = "xxhash")]
+    Xxh3,
+}
 
 pub struct Index {
     directory: PathBuf,
-    files: HashMap<String, String>,
+    files: HashMap<String, Entry>,
+}
+
+/// An indexed file.
+#[derive(Clone, Debug, PartialEq, Serialize, Deserialize)]
+pub struct Entry {
+    size: u64,
+    // the modification time, in nanoseconds since the epoch (0 if unknown)
+    modified: u64,
+    hash: String,
+}
+
+impl Entry {
+    /// Read the entry of given file, using `buffer` to read its content.
+    /// The metadata are the ones read while walking the directory, to avoid another stat().
+    fn read<P: AsRef<Path>>(
+        path: P,
+        metadata: &Metadata,
+        algorithm: Algorithm,
+        buffer: &mut [u8],
+    ) -> io::Result<Entry> {
+        Ok(Entry {
+            size: metadata.len(),
+            modified: modified(metadata),
+            hash: checksum(&path, algorithm, buffer)?,
+        })
+    }
+
+    /// Returns `true` if the file looks unchanged according to its metadata,
+    /// which means that its checksum can be reused.
+    fn is_unchanged(&self, metadata: &Metadata) -> bool {
+        self.modified != 0 && self.size == metadata.len() && self.modified == modified(metadata)
+    }
 }
 
 impl Index {
@@ -35,15 +114,22 @@ impl Index {
             return Ok(Index::blank(directory));
         }
 
-        // otherwise read index file line by line
-        let mut files: HashMap<String, String> = HashMap::new();
-        let buf = BufReader::new(File::open(index_path)?);
-        for line in buf.lines() {
-            let line = line.unwrap();
-            let parts: Vec<&str> = line.split(':').collect();
-            files.insert(parts[0].to_string(), parts[1].to_string());
+        // otherwise read the whole index file at once (decompressing it if needed)
+        let mut content = fs::read(index_path)?;
+        if content.starts_with(&ZSTD_MAGIC) {
+            content = zstd::decode_all(content.as_slice())?;
         }
 
+        let files = if content.first() == Some(&INDEX_HEADER) {
+            let (version, files): (u8, HashMap<String, Entry>) = rmp_serde::from_slice(&content)?;
+            if version != INDEX_VERSION {
+                return Err(format!("unsupported index version: {}", version).into());
+            }
+            files
+        } else {
+            parse_text_index(&String::from_utf8(content)?)?
+        };
+
         Ok(Index {
             directory: directory.as_ref().to_path_buf(),
             files,
@@ -51,7 +137,12 @@ impl Index {
     }
 
     /// Compute the index for given directory.
-    pub fn compute<P: AsRef<Path>>(directory: P) -> Result<(Index, usize), Box<dyn Error>> {
+    /// The checksums of the files which look unchanged since `previous` was computed
+    /// (same size and modification time) are reused instead of being computed again.
+    pub fn compute<P: AsRef<Path>>(
+        directory: P,
+        previous: &Index,
+    ) -> Result<(Index, usize), Box<dyn Error>> {
         // try to load .osyncignore file
         let mut ignored_files: HashMap<String, bool> = HashMap::new();
         if let Ok(file) = File::open(directory.as_ref().join(IGNORE_FILE)) {
@@ -61,28 +152,39 @@ impl Index {
             }
         }
 
-        // do not upload .osync(ignore) files
+        // do not upload .osync(ignore|dirs|.tmp) files
         ignored_files.insert(INDEX_FILE.to_string(), true);
+        ignored_files.insert(INDEX_TEMP_FILE.to_string(), true);
         ignored_files.insert(IGNORE_FILE.to_string(), true);
+        ignored_files.insert(DIRECTORY_CACHE_FILE.to_string(), true);
 
-        let mut files: HashMap<String, String> = HashMap::new();
+        let mut files: HashMap<String, Entry> = HashMap::with_capacity(previous.len());
+        let mut paths: Vec<(String, PathBuf, Metadata)> = Vec::new();
         for entry in WalkDir::new(&directory).into_iter().filter_map(|e| e.ok()) {
-            let local_path = entry.path().strip_prefix(&directory)?;
-            let metadata = entry.metadata().unwrap();
-
-            if metadata.is_file() && !ignored_files.contains_key(local_path.to_str().unwrap()) {
-                let bytes = fs::read(entry.path()).expect("unable to read file");
+            // the file type comes from the directory listing itself:
+            // skip the directories (and symlinks) before building the key or calling stat()
+            if !entry.file_type().is_file() {
+                continue;
+            }
 
-                let mut hasher = sha1::Sha1::new();
-                hasher.update(bytes);
+            let local_path = local_path(entry.path().strip_prefix(&directory)?);
+            if ignored_files.contains_key(&local_path) {
+                continue;
+            }
 
-                files.insert(
-                    local_path.to_str().unwrap().to_string(),
-                    format!("{:x}", hasher.finalize()),
-                );
+            let metadata = entry.metadata()?;
+            match previous.files.get(&local_path) {
+                Some(previous) if previous.is_unchanged(&metadata) => {
+                    files.insert(local_path, previous.clone());
+                }
+                // the file is new or has changed: compute its checksum
+                // (the checksums computed using another algorithm are simply replaced)
+                _ => paths.push((local_path, entry.into_path(), metadata)),
             }
         }
 
+        files.extend(read_entries(paths)?);
+
         Ok((
             Index {
                 directory: directory.as_ref().to_path_buf(),
@@ -93,16 +195,22 @@ impl Index {
     }
 
     /// Save the index to the disk.
+    /// The index is written to a temporary file which then replaces the previous one,
+    /// so that an interrupted save never leaves a truncated index behind.
     pub fn save(&self) -> Result<(), Box<dyn Error>> {
-        let mut file = File::create(self.directory.join(INDEX_FILE))?;
+        let temp_path = self.directory.join(INDEX_TEMP_FILE);
+        let file = File::create(&temp_path)?;
+        let mut file = BufWriter::new(zstd::Encoder::new(file, INDEX_COMPRESSION_LEVEL)?);
 
-        // create file content
-        let mut content = String::new();
-        for (path, hash) in self.files.iter() {
-            content += format!("{}:{}\n", path, hash).as_str();
-        }
+        // write the entries straight to the (buffered) compressor
+        // instead of building the whole content in memory first
+        rmp_serde::encode::write(&mut file, &(INDEX_VERSION, &self.files))?;
+
+        let file = file.into_inner().map_err(|e| e.into_error())?;
+        file.finish()?.sync_all()?;
+        fs::rename(temp_path, self.directory.join(INDEX_FILE))?;
 
-        file.write_all(content.as_bytes()).map_err(|e| e.into())
+        Ok(())
     }
 
     /// Compute the difference between the indexes self & b
@@ -111,15 +219,26 @@ impl Index {
         let mut changed_files: Vec<String> = Vec::new();
         let mut deleted_files: Vec<String> = Vec::new();
 
-        for (path, hash) in &b.files {
-            if self.files.get(path).is_none() || self.files.get(path).unwrap() != hash {
-                changed_files.push(path.to_string());
+        // number of files present in both indexes
+        let mut common_files = 0;
+        for (path, entry) in &b.files {
+            match self.files.get(path) {
+                Some(previous) => {
+                    common_files += 1;
+                    if previous.hash != entry.hash {
+                        changed_files.push(path.to_string());
+                    }
+                }
+                None => changed_files.push(path.to_string()),
             }
         }
 
-        for path in self.files.keys() {
-            if !b.files.contains_key(path) {
-                deleted_files.push(path.to_string());
+        // if every file of self is still in b, nothing has been deleted
+        if common_files < self.files.len() {
+            for path in self.files.keys() {
+                if !b.files.contains_key(path) {
+                    deleted_files.push(path.to_string());
+                }
             }
         }
 
@@ -141,18 +260,19 @@ impl Index {
         self.directory.clone()
     }
 
-    pub fn files(&self) -> &HashMap<String, String> {
+    pub fn files(&self) -> &HashMap<String, Entry> {
         &self.files
     }
 
-    pub fn update(&mut self, path: &str) -> Result<(), Box<dyn Error>> {
-        let bytes = fs::read(self.directory.join(path))?;
-
-        let mut hasher = sha1::Sha1::new();
-        hasher.update(bytes);
+    /// Copy the entry of given file from another index,
+    /// instead of reading the file again to compute its checksum.
+    pub fn update_from(&mut self, index: &Index, path: &str) -> Result<(), Box<dyn Error>> {
+        let entry = index
+            .files
+            .get(path)
+            .ok_or_else(|| format!("{} is not indexed", path))?;
 
-        self.files
-            .insert(path.to_string(), format!("{:x}", hasher.finalize()));
+        self.files.insert(path.to_string(), entry.clone());
         Ok(())
     }
 
@@ -162,12 +282,146 @@ impl Index {
     }
 }
 
+/// Parse an (older) plain text index.
+/// Each line is either path:size:modified:hash or path:hash,
+/// the split is made from the end since the path may contain some ':'
+fn parse_text_index(content: &str) -> Result<HashMap<String, Entry>, Box<dyn Error>> {
+    let mut files: HashMap<String, Entry> = HashMap::with_capacity(content.lines().count());
+    for line in content.lines().filter(|l| !l.is_empty()) {
+        let (rest, hash) = line
+            .rsplit_once(':')
+            .ok_or_else(|| format!("invalid index entry: {}", line))?;
+
+        let metadata = rest.rsplit_once(':').and_then(|(rest, modified)| {
+            let (path, size) = rest.rsplit_once(':')?;
+            Some((path, size.parse().ok()?, modified.parse().ok()?))
+        });
+        let (path, size, modified) = metadata.unwrap_or((rest, 0, 0));
+
+        files.insert(
+            path.to_string(),
+            Entry {
+                size,
+                modified,
+                hash: hash.to_string(),
+            },
+        );
+    }
+
+    Ok(files)
+}
+
+/// Returns the index key for given path (relative to the indexed directory).
+/// The components are always separated by '/' since the keys are used to build the remote paths.
+fn local_path(path: &Path) -> String {
+    let path = path.to_str().unwrap();
+    if MAIN_SEPARATOR == '/' {
+        path.to_string()
+    } else {
+        path.replace(MAIN_SEPARATOR, "/")
+    }
+}
+
+/// Returns the modification time of a file, in nanoseconds since the epoch (0 if unknown).
+fn modified(metadata: &Metadata) -> u64 {
+    metadata
+        .modified()
+        .ok()
+        .and_then(|modified| modified.duration_since(UNIX_EPOCH).ok())
+        .and_then(|duration| u64::try_from(duration.as_nanos()).ok())
+        .unwrap_or(0)
+}
+
+/// Compute the checksum of given file using given algorithm.
+/// The file is read by chunks of the size of `buffer`.
+fn checksum<P: AsRef<Path>>(
+    path: P,
+    algorithm: Algorithm,
+    buffer: &mut [u8],
+) -> io::Result<String> {
+    match algorithm {
+        Algorithm::Sha1 => {
+            let mut hasher = sha1::Sha1::new();
+            read_chunks(path, buffer, |chunk| hasher.update(chunk))?;
+            Ok(format!("{:x}", hasher.finalize()))
+        }
+        #[cfg(feature = "xxhash")]
+        Algorithm::Xxh3 => {
+            let mut hasher = xxhash_rust::xxh3::Xxh3::new();
+            read_chunks(path, buffer, |chunk| hasher.update(chunk))?;
+            Ok(format!("{}{:032x}", XXH3_PREFIX, hasher.digest128()))
+        }
+    }
+}
+
+/// Read given file by chunks (using `buffer`) so that big files are never fully loaded in memory.
+fn read_chunks<P: AsRef<Path>, F: FnMut(&[u8])>(
+    path: P,
+    buffer: &mut [u8],
+    mut f: F,
+) -> io::Result<()> {
+    let mut file = File::open(path)?;
+
+    loop {
+        match file.read(buffer) {
+            Ok(0) => return Ok(()),
+            Ok(n) => f(&buffer[..n]),
+            Err(e) if e.kind() == ErrorKind::Interrupted => continue,
+            Err(e) => return Err(e),
+        }
+    }
+}
+
+/// Read the entries of given files (local path, path, metadata) using all the available cores.
+fn read_entries(paths: Vec<(String, PathBuf, Metadata)>) -> io::Result<Vec<(String, Entry)>> {
+    let workers = thread::available_parallelism()
+        .map(|n| n.get())
+        .unwrap_or(1)
+        .min(paths.len());
+    let mut files: Vec<(String, Entry)> = Vec::with_capacity(paths.len());
+    let queue = Mutex::new(paths.into_iter());
+    // set as soon as a file cannot be read: the whole computation fails anyway
+    let stopped = AtomicBool::new(false);
+
+    thread::scope(|scope| {
+        let handles: Vec<_> = (0..workers)
+            .map(|_| {
+                scope.spawn(|| -> io::Result<Vec<(String, Entry)>> {
+                    let mut entries = Vec::new();
+                    // allocated once per worker rather than once per file
+                    let mut buffer = vec![0; CHECKSUM_BUFFER_SIZE];
+                    while !stopped.load(Ordering::Relaxed) {
+                        let (local_path, path, metadata) = match queue.lock().unwrap().next() {
+                            Some(entry) => entry,
+                            None => break,
+                        };
+                        match Entry::read(path, &metadata, DEFAULT_ALGORITHM, &mut buffer) {
+                            Ok(entry) => entries.push((local_path, entry)),
+                            Err(e) => {
+                                stopped.store(true, Ordering::Relaxed);
+                                return Err(e);
+                            }
+                        }
+                    }
+                    Ok(entries)
+                })
+            })
+            .collect();
+
+        for handle in handles {
+            files.extend(handle.join().unwrap()?);
+        }
+
+        Ok(files)
+    })
+}
+
 /// Allows you to access the index file directory with `[]`
 impl<'a> std::ops::Index<&'a str> for Index {
     type Output = String;
 
     fn index(&self, index: &'a str) -> &Self::Output {
-        &self.files[index]
+        &self.files[index].hash
     }
 }
 
@@ -177,7 +431,16 @@ mod tests {
 
     use tempdir::TempDir;
 
-    use crate::index::{Index, IGNORE_FILE, INDEX_FILE};
+    use crate::index::{
+        checksum, read_entries, Algorithm, Index, CHECKSUM_BUFFER_SIZE, IGNORE_FILE, INDEX_FILE,
+        INDEX_HEADER, INDEX_TEMP_FILE, ZSTD_MAGIC,
+    };
+
+    // checksum of "hello" using the default algorithm
+    #[cfg(not(feature = "xxhash"))]
+    const HELLO_CHECKSUM: &str = "aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d";
+    #[cfg(feature = "xxhash")]
+    const HELLO_CHECKSUM: &str = "xxh3-b5e9c1ad071b3e7fc779cfaa5e523818";
 
     #[test]
     fn test_blank() {
@@ -203,11 +466,51 @@ mod tests {
         assert_eq!(index["test"], "5d41402abc4b2a76b9719d911017c592");
     }
 
+    #[test]
+    fn test_load_path_with_colon() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        // create dummy index
+        fs::write(
+            dir.path().join(INDEX_FILE),
+            "a:b:5d41402abc4b2a76b9719d911017c592\n",
+        )
+        .expect("unable to write index");
+
+        let index = Index::load(dir).expect("unable to load index");
+        assert_eq!(index.len(), 1);
+        assert_eq!(index["a:b"], "5d41402abc4b2a76b9719d911017c592");
+    }
+
+    #[test]
+    fn test_save() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        fs::write(dir.path().join("test"), "hello").expect("unable to write test file");
+
+        let (index, _) =
+            Index::compute(&dir, &Index::blank(&dir)).expect("unable to compute index");
+        index.save().expect("unable to save index");
+
+        assert!(!dir.path().join(INDEX_TEMP_FILE).exists());
+        let content = fs::read(dir.path().join(INDEX_FILE)).expect("unable to read index");
+        assert!(content.starts_with(&ZSTD_MAGIC));
+        let content = zstd::decode_all(content.as_slice()).expect("unable to decompress index");
+        assert_eq!(content[0], INDEX_HEADER);
+
+        // the metadata are kept too
+        let loaded_index = Index::load(&dir).expect("unable to load index");
+        assert_eq!(loaded_index.len(), 1);
+        assert_eq!(loaded_index["test"], HELLO_CHECKSUM);
+        assert_eq!(loaded_index.files, index.files);
+    }
+
     #[test]
     fn test_compute_no_files() {
         let dir = TempDir::new("osync").expect("unable to create temp dir");
 
-        let (index, _) = Index::compute(&dir).expect("unable to compute index");
+        let (index, _) =
+            Index::compute(&dir, &Index::blank(&dir)).expect("unable to compute index");
         assert_eq!(index.len(), 0);
         assert_eq!(index.is_empty(), true);
     }
@@ -218,18 +521,123 @@ mod tests {
 
         fs::write(dir.path().join("test"), "hello").expect("unable to write test file");
 
-        let (index, _) = Index::compute(&dir).expect("unable to compute index");
+        let (index, _) =
+            Index::compute(&dir, &Index::blank(&dir)).expect("unable to compute index");
         assert_eq!(index.len(), 1);
         assert_eq!(index.is_empty(), false);
-        assert_eq!(index["test"], "aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d");
+        assert_eq!(index["test"], HELLO_CHECKSUM);
 
         // create a .osyncignore
         fs::write(dir.path().join(IGNORE_FILE), "test\n").expect("unable to write ignore file");
 
         // re compute index
-        let (index, ignored) = Index::compute(&dir).expect("unable to compute index");
+        let (index, ignored) =
+            Index::compute(&dir, &Index::blank(&dir)).expect("unable to compute index");
         assert_eq!(index.len(), 0);
-        assert_eq!(ignored, 3); // the .osyncignore/.osync files
+        assert_eq!(ignored, 5); // the .osyncignore/.osync/.osync.tmp/.osyncdirs files
+    }
+
+    #[test]
+    fn test_compute_with_directories() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        fs::create_dir_all(dir.path().join("a").join("b")).expect("unable to create directories");
+        fs::write(dir.path().join("a").join("b").join("test"), "hello")
+            .expect("unable to write test file");
+
+        let (index, _) =
+            Index::compute(&dir, &Index::blank(&dir)).expect("unable to compute index");
+        assert_eq!(index.len(), 1);
+        assert_eq!(index["a/b/test"], HELLO_CHECKSUM);
+    }
+
+    #[test]
+    fn test_compute_reuse_checksum() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        fs::write(dir.path().join("test"), "hello").expect("unable to write test file");
+
+        let (mut previous_index, _) =
+            Index::compute(&dir, &Index::blank(&dir)).expect("unable to compute index");
+        previous_index.files.get_mut("test").unwrap().hash = "cached".to_string();
+
+        // the file is unchanged: the checksum is reused
+        let (index, _) = Index::compute(&dir, &previous_index).expect("unable to compute index");
+        assert_eq!(index["test"], "cached");
+
+        // the file size has changed: the checksum is computed again
+        fs::write(dir.path().join("test"), "hello!").expect("unable to write test file");
+
+        let (index, _) = Index::compute(&dir, &previous_index).expect("unable to compute index");
+        assert_ne!(index["test"], "cached");
+    }
+
+    #[test]
+    fn test_update_from() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        fs::write(dir.path().join("test"), "hello").expect("unable to write test file");
+
+        let (current_index, _) =
+            Index::compute(&dir, &Index::blank(&dir)).expect("unable to compute index");
+
+        let mut index = Index::blank(&dir);
+        index
+            .update_from(&current_index, "test")
+            .expect("unable to update index");
+        assert_eq!(index["test"], HELLO_CHECKSUM);
+        assert!(index.update_from(&current_index, "missing").is_err());
+    }
+
+    #[test]
+    fn test_read_entries_missing_file() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        let mut paths = Vec::new();
+        for i in 0..100 {
+            let path = dir.path().join(i.to_string());
+            fs::write(&path, "hello").expect("unable to write test file");
+            let metadata = fs::metadata(&path).expect("unable to read metadata");
+            paths.push((i.to_string(), path, metadata));
+        }
+
+        // a file deleted after the directory has been walked
+        fs::remove_file(&paths[0].1).expect("unable to remove test file");
+
+        assert!(read_entries(paths).is_err());
+    }
+
+    #[test]
+    fn test_checksum() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        // make sure the file spans several chunks
+        let path = dir.path().join("test");
+        fs::write(&path, vec![b'a'; 2 * CHECKSUM_BUFFER_SIZE + 3])
+            .expect("unable to write test file");
+
+        assert_eq!(
+            checksum(&path, Algorithm::Sha1, &mut [0; 4096]).expect("unable to compute checksum"),
+            "cf2ed4568b19431b0d0a9ea5f894df6c7dd92c2f"
+        );
+    }
+
+    #[cfg(feature = "xxhash")]
+    #[test]
+    fn test_checksum_xxh3() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        // make sure the file spans several chunks
+        let path = dir.path().join("test");
+        let content = vec![b'a'; 2 * CHECKSUM_BUFFER_SIZE + 3];
+        fs::write(&path, &content).expect("unable to write test file");
+
+        let hash =
+            checksum(&path, Algorithm::Xxh3, &mut [0; 4096]).expect("unable to compute checksum");
+        assert_eq!(
+            hash,
+            format!("xxh3-{:032x}", xxhash_rust::xxh3::xxh3_128(&content))
+        );
     }
 
     #[test]
@@ -241,15 +649,39 @@ mod tests {
         // create dummy index
         fs::write(
             dir.path().join(INDEX_FILE),
-            "test:aaf4c61ddcc5e8a2dabede0f3b482cd9aea9434d",
+            format!("test:{}", HELLO_CHECKSUM),
         )
         .expect("unable to write index");
 
         let previous_index = Index::load(&dir).expect("unable to read index");
-        let (current_index, _) = Index::compute(&dir).expect("unable to compute index");
+        let (current_index, _) =
+            Index::compute(&dir, &previous_index).expect("unable to compute index");
 
         let (changed_files, deleted_files) = previous_index.diff(&current_index);
         assert_eq!(changed_files.len(), 0);
         assert!(deleted_files.is_empty());
     }
+
+    #[test]
+    fn test_diff_changed_and_deleted() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        fs::write(dir.path().join("a"), "hello").expect("unable to write test file");
+        fs::write(dir.path().join("b"), "hello").expect("unable to write test file");
+
+        // create dummy index
+        fs::write(
+            dir.path().join(INDEX_FILE),
+            format!("a:{}\nb:0\nc:0\n", HELLO_CHECKSUM),
+        )
+        .expect("unable to write index");
+
+        let previous_index = Index::load(&dir).expect("unable to read index");
+        let (current_index, _) =
+            Index::compute(&dir, &previous_index).expect("unable to compute index");
+
+        let (changed_files, deleted_files) = previous_index.diff(&current_index);
+        assert_eq!(changed_files, vec!["b".to_string()]);
+        assert_eq!(deleted_files, vec!["c".to_string()]);
+    }
 }
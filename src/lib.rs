@@ -1,2 +1,4 @@
 pub mod index;
+#[cfg(feature = "sftp")]
+pub mod sftp;
 pub mod sync;
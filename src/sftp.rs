@@ -0,0 +1,244 @@
+use std::env;
+use std::error::Error;
+use std::fs::File;
+use std::io::{self, BufReader};
+use std::net::TcpStream;
+use std::path::Path;
+
+use indicatif::ProgressBar;
+use ssh2::{CheckResult, KnownHostFileKind, Session, Sftp};
+use url::Url;
+
+use crate::index::Index;
+use crate::sync::{
+    create_directories, destination, for_each_file, remote_dir, synchronize_files, DirectoryCache,
+    Pool, RemoteDirectories, Sync, ThreadError, Transfer, UPLOAD_BUFFER_SIZE,
+};
+
+/// A synchronizer which save by SFTP.
+/// Everything goes through a single SSH connection per session:
+/// no data connection has to be opened for each file, unlike FTP.
+pub struct SftpSync {
+    dst: Url,
+    // the maximum number of sessions
+    parallel: usize,
+    // the SFTP sessions, only opened if there's something to transfer
+    sessions: Option<Pool<Sftp>>,
+    remote_dir: String,
+    // create a local cache of existing directories
+    // so that we won't waste time trying to create them again
+    existing_directories: DirectoryCache,
+}
+
+impl Sync for SftpSync {
+    fn synchronize(
+        &mut self,
+        current_index: &Index,
+        previous_index: &mut Index,
+        assume_directories: bool,
+    ) -> Result<bool, Box<dyn Error>> {
+        synchronize_files(
+            Some(self),
+            current_index,
+            previous_index,
+            assume_directories,
+        )?;
+
+        Ok(false)
+    }
+}
+
+impl SftpSync {
+    pub fn new(dst: &Url, parallel: usize) -> Result<SftpSync, Box<dyn Error>> {
+        Ok(SftpSync {
+            dst: dst.clone(),
+            parallel: parallel.max(1),
+            sessions: None,
+            remote_dir: remote_dir(dst),
+            existing_directories: DirectoryCache::new(destination(dst, 22)),
+        })
+    }
+}
+
+impl Transfer for SftpSync {
+    fn parallel(&self) -> usize {
+        self.parallel
+    }
+
+    fn open(&mut self, size: usize) -> Result<usize, Box<dyn Error>> {
+        let dst = &self.dst;
+        let host = dst.host_str().expect("missing address");
+        let port = dst.port().unwrap_or(22);
+        let sessions = Pool::open(size, || connect(host, port, dst.username(), dst.password()))
+            .map_err(|e| e as Box<dyn Error>)?;
+        let opened = sessions.size();
+        self.sessions = Some(sessions);
+
+        Ok(opened)
+    }
+
+    fn remote_dir(&self) -> &str {
+        &self.remote_dir
+    }
+
+    fn existing_directories(&mut self) -> &mut DirectoryCache {
+        &mut self.existing_directories
+    }
+
+    fn process_changed_files(
+        &mut self,
+        progress_bar: &ProgressBar,
+        current_index: &Index,
+        previous_index: &mut Index,
+        files: &[String],
+    ) -> Result<(), Box<dyn Error>> {
+        let local_dir = previous_index.path();
+        let sessions = self.sessions.as_ref().expect("the sessions are not opened");
+
+        if !files.is_empty() {
+            let mut session = sessions.acquire();
+            create_directories(
+                &mut *session,
+                &mut self.existing_directories,
+                &self.remote_dir,
+                files,
+            )?;
+        }
+
+        for_each_file(
+            sessions,
+            previous_index,
+            files,
+            1,
+            |session, paths, done| {
+                for path in paths {
+                    // the file is written by big chunks: libssh2 splits each of them
+                    // into several write requests which are all in flight at once
+                    let mut content = BufReader::with_capacity(
+                        UPLOAD_BUFFER_SIZE,
+                        File::open(local_dir.join(path))?,
+                    );
+                    let mut remote_file =
+                        session.create(Path::new(&format!("{}/{}", &self.remote_dir, path)))?;
+                    io::copy(&mut content, &mut remote_file)?;
+                    // the close errors are ignored on drop
+                    remote_file.close()?;
+
+                    done(path);
+                }
+
+                Ok(())
+            },
+            |index, path| {
+                // the file has just been indexed, no need to read it again
+                index.update_from(current_index, path)?;
+
+                progress_bar.println(format!("[+] {}", path));
+                progress_bar.inc(1);
+
+                Ok(())
+            },
+        )
+    }
+
+    fn process_deleted_files(
+        &mut self,
+        progress_bar: &ProgressBar,
+        previous_index: &mut Index,
+        files: &[String],
+    ) -> Result<(), Box<dyn Error>> {
+        let sessions = self.sessions.as_ref().expect("the sessions are not opened");
+
+        for_each_file(
+            sessions,
+            previous_index,
+            files,
+            1,
+            |session, paths, done| {
+                for path in paths {
+                    session.unlink(Path::new(&format!("{}/{}", &self.remote_dir, path)))?;
+                    done(path);
+                }
+
+                Ok(())
+            },
+            |index, path| {
+                index.remove(path)?;
+
+                progress_bar.println(format!("[-] {}", path));
+                progress_bar.inc(1);
+
+                Ok(())
+            },
+        )
+    }
+}
+
+impl RemoteDirectories for Sftp {
+    fn mkdir(&mut self, path: &str) -> Result<(), Box<dyn Error>> {
+        Sftp::mkdir(self, Path::new(path), 0o755).map_err(|e| e.into())
+    }
+
+    fn directory_exist(&mut self, path: &str) -> Result<bool, Box<dyn Error>> {
+        // a single STAT request, no need to list the parent
+        Ok(self
+            .stat(Path::new(path))
+            .map(|stat| stat.is_dir())
+            .unwrap_or(false))
+    }
+}
+
+fn connect(
+    host: &str,
+    port: u16,
+    username: &str,
+    password: Option<&str>,
+) -> Result<Sftp, ThreadError> {
+    let stream = TcpStream::connect((host, port))?;
+    stream.set_nodelay(true)?;
+
+    let mut session = Session::new()?;
+    session.set_tcp_stream(stream);
+    session.handshake()?;
+
+    // make sure this is the expected server before sending it any credentials
+    check_host_key(&session, host, port)?;
+
+    // authenticate using the password if provided, the SSH agent otherwise
+    match password {
+        Some(password) => session.userauth_password(username, password)?,
+        None => session.userauth_agent(username)?,
+    }
+
+    Ok(session.sftp()?)
+}
+
+/// Check the key of the server against the hosts known by the user (~/.ssh/known_hosts).
+/// An unknown server is rejected too: it has to be trusted beforehand (by connecting to it using ssh).
+fn check_host_key(session: &Session, host: &str, port: u16) -> Result<(), ThreadError> {
+    let home = env::var_os("HOME").ok_or("unable to find the known hosts: HOME is not set")?;
+    let mut known_hosts = session.known_hosts()?;
+    // if the file cannot be read no host is known, which is reported below
+    let _ = known_hosts.read_file(
+        &Path::new(&home).join(".ssh").join("known_hosts"),
+        KnownHostFileKind::OpenSSH,
+    );
+
+    let (key, _) = session
+        .host_key()
+        .ok_or("the server has not sent its host key")?;
+    match known_hosts.check_port(host, port, key) {
+        CheckResult::Match => Ok(()),
+        CheckResult::NotFound => Err(format!(
+            "the host key of {} is unknown, connect to it once using ssh to trust it",
+            host
+        )
+        .into()),
+        CheckResult::Mismatch => Err(format!(
+            "the host key of {} does not match the known one, the server may be impersonated",
+            host
+        )
+        .into()),
+        CheckResult::Failure => Err(format!("unable to check the host key of {}", host).into()),
+    }
+}
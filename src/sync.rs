@@ -1,14 +1,23 @@
-use std::collections::HashMap;
+use std::cell::Cell;
+use std::collections::{HashMap, HashSet};
 use std::error::Error;
+use std::fs;
 use std::fs::File;
-use std::path::{Path, PathBuf};
+use std::io::{self, BufReader, BufWriter, ErrorKind, Read, Write};
+use std::iter;
+use std::net::TcpStream;
+use std::ops::{Deref, DerefMut};
+use std::path::Path;
+use std::sync::{mpsc, Condvar, Mutex};
+use std::thread;
+use std::time::{Duration, Instant, SystemTime, UNIX_EPOCH};
 
 use ftp::types::FileType;
-use ftp::FtpStream;
+use ftp::{status, FtpError, FtpStream};
 use indicatif::{ProgressBar, ProgressStyle};
 use url::Url;
 
-use crate::index::Index;
+use crate::index::{Index, DIRECTORY_CACHE_FILE};
 
 pub trait Sync {
     fn synchronize(
@@ -19,15 +28,281 @@ pub trait Sync {
     ) -> Result<bool, Box<dyn Error>>;
 }
 
+/// Size of the chunks read from the files and sent to the server while uploading them.
+pub(crate) const UPLOAD_BUFFER_SIZE: usize = 1024 * 1024;
+
+/// Number of DELE commands sent at once before reading back their responses.
+const DELETE_PIPELINE_DEPTH: usize = 64;
+
+/// How often the index is saved while the files are processed (it is saved once more at the end),
+/// rewriting it after each file would take longer than the transfers themselves.
+const INDEX_SAVE_INTERVAL: Duration = Duration::from_secs(5);
+
+/// How long a cached directory is assumed to still exist on the server, in seconds.
+const DIRECTORY_CACHE_TTL: u64 = 7 * 24 * 60 * 60;
+
+/// Error type used by the upload threads.
+pub(crate) type ThreadError = Box<dyn Error + Send + std::marker::Sync>;
+
+/// The directories known to exist on the server.
+/// The cache is saved next to the index so that the directories are not probed again on the next run,
+/// each one being trusted for `DIRECTORY_CACHE_TTL` after it has been seen.
+pub(crate) struct DirectoryCache {
+    // the server & remote directory the cache has been built against
+    destination: String,
+    // the directories, along with the time they have been seen (in seconds since the epoch)
+    directories: HashMap<String, u64>,
+}
+
+impl DirectoryCache {
+    pub(crate) fn new(destination: String) -> DirectoryCache {
+        DirectoryCache {
+            destination,
+            directories: HashMap::new(),
+        }
+    }
+
+    /// Load the cache saved in given directory, unless it has been built against another destination.
+    /// The cache is only used to save some round trips: if it cannot be read, it is simply ignored.
+    pub(crate) fn load(&mut self, directory: &Path) {
+        let content = match fs::read_to_string(directory.join(DIRECTORY_CACHE_FILE)) {
+            Ok(content) => content,
+            Err(_) => return,
+        };
+
+        // the first line is the destination, then each line is seen:directory
+        let mut lines = content.lines();
+        if lines.next() != Some(self.destination.as_str()) {
+            return;
+        }
+
+        let expired = now().saturating_sub(DIRECTORY_CACHE_TTL);
+        for line in lines {
+            if let Some((seen, directory)) = line.split_once(':') {
+                match seen.parse::<u64>() {
+                    Ok(seen) if seen > expired => {
+                        self.directories.insert(directory.to_string(), seen);
+                    }
+                    _ => {}
+                }
+            }
+        }
+    }
+
+    /// Save the cache in given directory.
+    pub(crate) fn save(&self, directory: &Path) -> io::Result<()> {
+        let mut file = BufWriter::new(File::create(directory.join(DIRECTORY_CACHE_FILE))?);
+
+        writeln!(file, "{}", self.destination)?;
+        for (directory, seen) in &self.directories {
+            writeln!(file, "{}:{}", seen, directory)?;
+        }
+
+        file.flush()
+    }
+
+    /// Returns `true` if given directory is known to exist.
+    pub(crate) fn contains(&self, directory: &str) -> bool {
+        self.directories.contains_key(directory)
+    }
+
+    /// Mark given directory as existing.
+    pub(crate) fn insert(&mut self, directory: &str) {
+        self.directories.insert(directory.to_string(), now());
+    }
+
+    /// Forget every directory, so that they are all probed again.
+    pub(crate) fn clear(&mut self) {
+        self.directories.clear();
+    }
+}
+
+/// Returns the key identifying given destination in the directory cache (credentials excluded).
+pub(crate) fn destination(dst: &Url, default_port: u16) -> String {
+    format!(
+        "{}://{}@{}:{}{}",
+        dst.scheme(),
+        dst.username(),
+        dst.host_str().unwrap_or(""),
+        dst.port().unwrap_or(default_port),
+        dst.path()
+    )
+}
+
+/// Returns the current time, in seconds since the epoch.
+fn now() -> u64 {
+    SystemTime::now()
+        .duration_since(UNIX_EPOCH)
+        .map(|duration| duration.as_secs())
+        .unwrap_or(0)
+}
+
+/// A pool of sessions opened against the same server.
+/// The sessions are all opened at once and then reused for every file.
+pub(crate) struct Pool<S> {
+    // number of sessions opened
+    size: usize,
+    idle_sessions: Mutex<Vec<S>>,
+    session_released: Condvar,
+}
+
+impl<S: Send> Pool<S> {
+    /// Open (up to) `size` sessions using given function.
+    /// The sessions are opened simultaneously so that the login round trips are only paid once.
+    /// Some servers limit the number of connections per client: the pool is then smaller,
+    /// this only fails if no session at all can be opened.
+    pub(crate) fn open<E, C>(size: usize, connect: C) -> Result<Pool<S>, E>
+    where
+        E: Send,
+        C: Fn() -> Result<S, E> + std::marker::Sync,
+    {
+        let results: Vec<Result<S, E>> = thread::scope(|scope| {
+            let handles: Vec<_> = (0..size).map(|_| scope.spawn(&connect)).collect();
+
+            handles
+                .into_iter()
+                .map(|handle| handle.join().unwrap())
+                .collect()
+        });
+
+        let mut sessions = Vec::with_capacity(size);
+        let mut error = None;
+        for result in results {
+            match result {
+                Ok(session) => sessions.push(session),
+                Err(e) => error = error.or(Some(e)),
+            }
+        }
+
+        if let Some(e) = error {
+            if sessions.is_empty() {
+                return Err(e);
+            }
+        }
+
+        Ok(Pool {
+            size: sessions.len(),
+            idle_sessions: Mutex::new(sessions),
+            session_released: Condvar::new(),
+        })
+    }
+
+    /// Returns the number of sessions opened.
+    pub(crate) fn size(&self) -> usize {
+        self.size
+    }
+
+    /// Wait for an idle session.
+    /// The session is given back to the pool once the returned guard is dropped.
+    pub(crate) fn acquire(&self) -> PooledSession<'_, S> {
+        let mut idle_sessions = self.idle_sessions.lock().unwrap();
+        loop {
+            if let Some(session) = idle_sessions.pop() {
+                return PooledSession {
+                    pool: self,
+                    session: Some(session),
+                };
+            }
+            idle_sessions = self.session_released.wait(idle_sessions).unwrap();
+        }
+    }
+}
+
+/// A session borrowed from a `Pool`.
+pub(crate) struct PooledSession<'a, S> {
+    pool: &'a Pool<S>,
+    session: Option<S>,
+}
+
+impl<S> Deref for PooledSession<'_, S> {
+    type Target = S;
+
+    fn deref(&self) -> &Self::Target {
+        self.session.as_ref().unwrap()
+    }
+}
+
+impl<S> DerefMut for PooledSession<'_, S> {
+    fn deref_mut(&mut self) -> &mut Self::Target {
+        self.session.as_mut().unwrap()
+    }
+}
+
+impl<S> Drop for PooledSession<'_, S> {
+    fn drop(&mut self) {
+        if let Some(session) = self.session.take() {
+            self.pool.idle_sessions.lock().unwrap().push(session);
+            self.pool.session_released.notify_one();
+        }
+    }
+}
+
+/// A pool of FTP sessions, along with the extensions supported by the server.
+struct FtpPool {
+    // the extensions advertised by the server (FEAT)
+    // probed once since every session talks to the same server
+    features: HashSet<String>,
+    sessions: Pool<FtpStream>,
+}
+
+impl FtpPool {
+    /// Open `size` sessions against given server.
+    fn open(dst: &Url, size: usize) -> Result<FtpPool, Box<dyn Error>> {
+        let address = format!(
+            "{}:{}",
+            dst.host_str().expect("missing address"),
+            dst.port().unwrap_or(21)
+        );
+
+        let sessions = Pool::open(size, || connect(&address, dst.username(), dst.password()))?;
+        let features = features(&mut sessions.acquire())?;
+
+        Ok(FtpPool { features, sessions })
+    }
+
+    /// Returns `true` if the server has advertised given extension.
+    fn supports(&self, feature: &str) -> bool {
+        self.features.contains(feature)
+    }
+}
+
+fn connect(address: &str, username: &str, password: Option<&str>) -> Result<FtpStream, FtpError> {
+    let mut session = FtpStream::connect(address)?;
+
+    // commands are small and often pipelined: send them right away
+    session
+        .get_ref()
+        .set_nodelay(true)
+        .map_err(FtpError::ConnectionError)?;
+
+    // authenticate if required
+    if !username.is_empty() {
+        session.login(username, password.unwrap_or(""))?;
+    }
+
+    // set transfer mode to binary
+    session.transfer_type(FileType::Binary)?;
+
+    Ok(session)
+}
+
 /// A synchronizer which save by FTP.
 pub struct FtpSync {
-    // the FTP session
     // if none it means that we are running with --skip-upload
-    ftp_session: Option<FtpStream>,
+    transfer: Option<FtpTransfer>,
+}
+
+/// The transfers of a `FtpSync`.
+struct FtpTransfer {
+    dst: Url,
+    // the maximum number of sessions
+    parallel: usize,
+    // the FTP sessions, only opened if there's something to transfer
+    ftp_pool: Option<FtpPool>,
     remote_dir: String,
     // create a local cache of existing directories
     // so that we won't waste time trying to create them again
-    existing_directories: HashMap<String, bool>,
+    existing_directories: DirectoryCache,
 }
 
 impl Sync for FtpSync {
@@ -37,174 +312,1036 @@ impl Sync for FtpSync {
         previous_index: &mut Index,
         assume_directories: bool,
     ) -> Result<bool, Box<dyn Error>> {
-        // compute diff
-        let (changed_files, deleted_files) = previous_index.diff(current_index);
-        println!("-> {} files changed", changed_files.len());
-        println!("-> {} files deleted", deleted_files.len());
-
-        // If set to true, use the local cache to determinate existing directories
-        // this will greatly reduce upload duration since we do not need to try to create ALL directories.
-        if assume_directories {
-            for path in previous_index.files().keys() {
-                let path = Path::new(&path);
-
-                // remove last component from path (the file)
-                if path.parent().is_none() {
-                    continue;
-                }
-                let path = path.parent().unwrap().to_str().unwrap();
-
-                let mut current_dir = self.remote_dir.clone();
-                for folder in path.split('/').filter(|f| !f.is_empty()) {
-                    current_dir = format!("{}/{}", current_dir, folder);
-                    self.existing_directories
-                        .insert(current_dir.to_string(), true);
-                }
-            }
-        }
-
-        if self.ftp_session.is_some() {
-            // create progress bar
-            let pb = ProgressBar::new((changed_files.len() + deleted_files.len()) as u64);
-            pb.set_style(ProgressStyle::default_bar().template(
-                "{spinner:.green} [{elapsed_precise}] [{bar:40.cyan/blue}] ({pos}/{len}, ETA {eta})",
-            ));
-
-            self.process_changed_files(&pb, previous_index, &changed_files)?;
-            self.process_deleted_files(&pb, previous_index, &deleted_files)?;
-        }
-
-        // everything is fine, save index to file
-        current_index.save()?;
+        synchronize_files(
+            self.transfer.as_mut(),
+            current_index,
+            previous_index,
+            assume_directories,
+        )?;
 
-        Ok(self.ftp_session.is_none())
+        Ok(self.transfer.is_none())
     }
 }
 
 impl FtpSync {
-    pub fn new(dst: &Option<Url>) -> Result<FtpSync, Box<dyn Error>> {
-        let mut ftp_session = None;
-        let mut remote_dir = "";
-
+    pub fn new(dst: &Option<Url>, parallel: usize) -> Result<FtpSync, Box<dyn Error>> {
         // If an URL is provided
-        if let Some(dst) = dst {
-            // open FTP connection
-            let address = format!(
-                "{}:{}",
-                dst.host_str().expect("missing address"),
-                dst.port().unwrap_or(21)
-            );
-
-            let mut session = FtpStream::connect(address)?;
-
-            // authenticate if required
-            if dst.username() != "" {
-                session.login(dst.username(), dst.password().unwrap_or(""))?;
-            }
+        let transfer = dst.as_ref().map(|dst| FtpTransfer {
+            dst: dst.clone(),
+            parallel: parallel.max(1),
+            ftp_pool: None,
+            remote_dir: remote_dir(dst),
+            existing_directories: DirectoryCache::new(destination(dst, 21)),
+        });
+
+        Ok(FtpSync { transfer })
+    }
+}
 
-            // set transfer mode to binary
-            session.transfer_type(FileType::Binary)?;
+impl Transfer for FtpTransfer {
+    fn parallel(&self) -> usize {
+        self.parallel
+    }
 
-            ftp_session = Some(session);
+    fn open(&mut self, size: usize) -> Result<usize, Box<dyn Error>> {
+        let ftp_pool = FtpPool::open(&self.dst, size)?;
+        let opened = ftp_pool.sessions.size();
+        self.ftp_pool = Some(ftp_pool);
 
-            // setup custom root directory if required
-            remote_dir = if dst.path() != "" { dst.path() } else { "/" };
-        }
+        Ok(opened)
+    }
 
-        Ok(FtpSync {
-            ftp_session,
-            remote_dir: remote_dir.to_string(),
-            existing_directories: HashMap::new(),
-        })
+    fn remote_dir(&self) -> &str {
+        &self.remote_dir
+    }
+
+    fn existing_directories(&mut self) -> &mut DirectoryCache {
+        &mut self.existing_directories
     }
 
     fn process_changed_files(
         &mut self,
         progress_bar: &ProgressBar,
+        current_index: &Index,
         previous_index: &mut Index,
         files: &[String],
     ) -> Result<(), Box<dyn Error>> {
-        for path in files {
-            // extract parent directory
-            let p = PathBuf::from(path.clone());
-            let parent = p.parent().unwrap().to_str().unwrap();
+        let local_dir = previous_index.path();
+        let ftp_pool = self.ftp_pool.as_ref().expect("the sessions are not opened");
 
-            // create any missing directories (recursively)
-            self.make_directories(&format!("{}/{}", &self.remote_dir, parent))?;
+        if !files.is_empty() {
+            let mut session = ftp_pool.sessions.acquire();
+            let mut directories = FtpDirectories {
+                session: &mut session,
+                use_mlst: ftp_pool.supports("MLST"),
+            };
+            create_directories(
+                &mut directories,
+                &mut self.existing_directories,
+                &self.remote_dir,
+                files,
+            )?;
+        }
 
-            // store the file on the server
-            let mut content = File::open(previous_index.path().join(path))?;
-            self.ftp_session
-                .as_mut()
-                .unwrap()
-                .put(&format!("{}/{}", &self.remote_dir, path), &mut content)?;
-            previous_index.update(&path)?;
-            previous_index.save()?;
+        for_each_file(
+            &ftp_pool.sessions,
+            previous_index,
+            files,
+            1,
+            |session, paths, done| {
+                for path in paths {
+                    // store the file on the server
+                    // the file is read by big chunks so that each one is sent at once
+                    let mut content = BufReader::with_capacity(
+                        UPLOAD_BUFFER_SIZE,
+                        File::open(local_dir.join(path))?,
+                    );
+                    session.put(&format!("{}/{}", &self.remote_dir, path), &mut content)?;
 
-            progress_bar.println(format!("[+] {}", path));
-            progress_bar.inc(1);
-        }
+                    done(path);
+                }
 
-        Ok(())
+                Ok(())
+            },
+            |index, path| {
+                // the file has just been indexed, no need to read it again
+                index.update_from(current_index, path)?;
+
+                progress_bar.println(format!("[+] {}", path));
+                progress_bar.inc(1);
+
+                Ok(())
+            },
+        )
     }
+
     fn process_deleted_files(
         &mut self,
         progress_bar: &ProgressBar,
         previous_index: &mut Index,
         files: &[String],
     ) -> Result<(), Box<dyn Error>> {
-        for path in files {
-            self.ftp_session
-                .as_mut()
-                .unwrap()
-                .rm(&format!("{}/{}", &self.remote_dir, path))?;
-            previous_index.remove(path)?;
-            previous_index.save()?;
+        let ftp_pool = self.ftp_pool.as_ref().expect("the sessions are not opened");
 
-            progress_bar.println(format!("[-] {}", path));
-            progress_bar.inc(1);
-        }
+        for_each_file(
+            &ftp_pool.sessions,
+            previous_index,
+            files,
+            DELETE_PIPELINE_DEPTH,
+            |session, paths, done| delete_files(session, &self.remote_dir, paths, done),
+            |index, path| {
+                index.remove(path)?;
+
+                progress_bar.println(format!("[-] {}", path));
+                progress_bar.inc(1);
+
+                Ok(())
+            },
+        )?;
 
         // TODO: it could be great to delete empty directory too
 
         Ok(())
     }
+}
+
+/// The directories of a FTP server.
+struct FtpDirectories<'a> {
+    session: &'a mut FtpStream,
+    use_mlst: bool,
+}
+
+impl RemoteDirectories for FtpDirectories<'_> {
+    fn mkdir(&mut self, path: &str) -> Result<(), Box<dyn Error>> {
+        self.session.mkdir(path).map_err(|e| e.into())
+    }
+
+    fn directory_exist(&mut self, path: &str) -> Result<bool, Box<dyn Error>> {
+        // MLST answers on the control connection, without opening a data connection
+        if self.use_mlst {
+            let (code, facts) = raw_command(self.session, &format!("MLST {}", path))?;
+
+            // the facts look like ` type=dir;modify=20210101000000; /path`
+            return Ok(code == status::REQUESTED_FILE_ACTION_OK
+                && facts.iter().any(|f| {
+                    let f = f.to_lowercase();
+                    f.contains("type=dir;") || f.contains("type=cdir;")
+                }));
+        }
+
+        // otherwise try to enter the directory, which does not require a data connection
+        // nor to list the whole parent either (the working directory does not matter
+        // since every path sent to the server is absolute)
+        let (code, _) = raw_command(self.session, &format!("CWD {}", path))?;
+        Ok(code == status::REQUESTED_FILE_ACTION_OK)
+    }
+}
+
+/// The operations implemented by each protocol, so that the files can be synchronized
+/// using `synchronize_files`.
+pub(crate) trait Transfer {
+    /// Returns the maximum number of sessions to open (--parallel).
+    fn parallel(&self) -> usize;
+
+    /// Open (up to) `size` sessions against the server, returns the number of sessions opened.
+    fn open(&mut self, size: usize) -> Result<usize, Box<dyn Error>>;
+
+    /// Returns the directory of the server the files are synchronized to.
+    fn remote_dir(&self) -> &str;
+
+    /// Returns the cache of the directories known to exist on the server.
+    fn existing_directories(&mut self) -> &mut DirectoryCache;
+
+    /// Upload given files, the index is updated as soon as a file has been uploaded.
+    fn process_changed_files(
+        &mut self,
+        progress_bar: &ProgressBar,
+        current_index: &Index,
+        previous_index: &mut Index,
+        files: &[String],
+    ) -> Result<(), Box<dyn Error>>;
+
+    /// Delete given files, the index is updated as soon as a file has been deleted.
+    fn process_deleted_files(
+        &mut self,
+        progress_bar: &ProgressBar,
+        previous_index: &mut Index,
+        files: &[String],
+    ) -> Result<(), Box<dyn Error>>;
+}
+
+/// Synchronize the changes between the indexes using given transfer.
+/// If there's none (--skip-upload) only the index is saved.
+pub(crate) fn synchronize_files<T: Transfer>(
+    transfer: Option<&mut T>,
+    current_index: &Index,
+    previous_index: &mut Index,
+    assume_directories: bool,
+) -> Result<(), Box<dyn Error>> {
+    // compute diff
+    let (changed_files, deleted_files) = previous_index.diff(current_index);
+    println!("-> {} files changed", changed_files.len());
+    println!("-> {} files deleted", deleted_files.len());
+
+    let transfer = match transfer {
+        Some(transfer) if !changed_files.is_empty() || !deleted_files.is_empty() => transfer,
+        // --skip-upload or nothing to transfer: only save the index
+        _ => return current_index.save(),
+    };
+
+    // no need to open more sessions than there are files
+    let size = transfer
+        .parallel()
+        .min(changed_files.len() + deleted_files.len());
+    let opened = transfer.open(size)?;
+    if opened < size {
+        println!("-> only {} sessions out of {} opened", opened, size);
+    }
+
+    // reuse the directories seen during the previous runs
+    transfer.existing_directories().load(&previous_index.path());
+
+    // If set to true, use the local cache to determinate existing directories
+    // this will greatly reduce upload duration since we do not need to try to create ALL directories.
+    if assume_directories {
+        for directory in parent_directories(previous_index.files().keys()) {
+            let directory = remote_directory(transfer.remote_dir(), directory);
+            for current_dir in ancestors(&directory) {
+                transfer.existing_directories().insert(current_dir);
+            }
+        }
+    }
+
+    // create progress bar
+    let pb = ProgressBar::new((changed_files.len() + deleted_files.len()) as u64);
+    pb.set_style(ProgressStyle::default_bar().template(
+        "{spinner:.green} [{elapsed_precise}] [{bar:40.cyan/blue}] ({pos}/{len}, ETA {eta})",
+    ));
+
+    let result = transfer
+        .process_changed_files(&pb, current_index, previous_index, &changed_files)
+        .and_then(|_| transfer.process_deleted_files(&pb, previous_index, &deleted_files));
+
+    match result {
+        // everything is fine, save index to file
+        Ok(_) => current_index.save()?,
+        // the failure may come from a cached directory which has been removed from the server since,
+        // every following run would then fail the same way: forget them so that they are probed again
+        Err(_) => transfer.existing_directories().clear(),
+    }
+
+    // the cache only saves some round trips: failing to save it is not an error
+    if let Err(e) = transfer.existing_directories().save(&previous_index.path()) {
+        println!("-> unable to save the directory cache ({})", e);
+    }
+
+    result
+}
+
+/// Returns the directory of the server given URL points to.
+pub(crate) fn remote_dir(dst: &Url) -> String {
+    // setup custom root directory if required
+    if dst.path().is_empty() {
+        "/".to_string()
+    } else {
+        dst.path().to_string()
+    }
+}
 
-    fn make_directories(&mut self, path: &str) -> Result<(), Box<dyn Error>> {
-        let mut current_dir = String::new();
+/// Run `operation` against batches of (at most) `batch_size` files,
+/// using every session of the pool at once.
+/// `operation` must call `done` for each file successfully processed,
+/// `on_success` is then called from the current thread so it can safely update `index`.
+/// The index is saved periodically, and once more at the end (even if some files have failed).
+pub(crate) fn for_each_file<'a, T, O, S>(
+    pool: &Pool<T>,
+    index: &mut Index,
+    files: &'a [String],
+    batch_size: usize,
+    operation: O,
+    mut on_success: S,
+) -> Result<(), Box<dyn Error>>
+where
+    T: Send,
+    O: Fn(&mut T, &'a [String], &dyn Fn(&'a String)) -> Result<(), ThreadError> + std::marker::Sync,
+    S: FnMut(&mut Index, &str) -> Result<(), Box<dyn Error>>,
+{
+    let batches = files.chunks(batch_size);
+    let workers = pool.size.min(batches.len());
+    let queue = Mutex::new(batches);
+    let (tx, rx) = mpsc::channel::<Result<&String, ThreadError>>();
+    let mut last_save = Instant::now();
 
-        for folder in path.split('/').filter(|f| !f.is_empty()) {
-            let next_dir = format!("{}/{}", current_dir, folder);
+    let result = thread::scope(|scope| {
+        for _ in 0..workers {
+            let (tx, queue, operation) = (tx.clone(), &queue, &operation);
 
-            // if the directory is not yet in the cache
-            if !self.existing_directories.contains_key(&next_dir) {
-                // create directory if not already exist
-                if !self.directory_exist(&current_dir, &folder)? {
-                    self.ftp_session.as_mut().unwrap().mkdir(&next_dir)?;
+            scope.spawn(move || {
+                let mut session = pool.acquire();
+
+                // set as soon as the receiver is gone (an error has occurred)
+                let stopped = Cell::new(false);
+                let done = |path: &'a String| {
+                    if tx.send(Ok(path)).is_err() {
+                        stopped.set(true);
+                    }
+                };
+
+                while !stopped.get() {
+                    let paths = match queue.lock().unwrap().next() {
+                        Some(paths) => paths,
+                        None => break,
+                    };
+
+                    if let Err(e) = operation(&mut session, paths, &done) {
+                        let _ = tx.send(Err(e));
+                        break;
+                    }
                 }
+            });
+        }
+        drop(tx);
 
-                // insert directory into cache
-                self.existing_directories.insert(next_dir.to_string(), true);
+        for result in rx {
+            match result {
+                Ok(path) => on_success(index, path)?,
+                Err(e) => return Err(e as Box<dyn Error>),
             }
 
-            current_dir = next_dir;
+            // rewriting the index after each file would take longer than the transfers themselves
+            if last_save.elapsed() >= INDEX_SAVE_INTERVAL {
+                index.save()?;
+                last_save = Instant::now();
+            }
         }
 
         Ok(())
+    });
+
+    // save the progress made, even if some files have failed
+    // (their failure is then reported rather than the one of the save)
+    let saved = index.save();
+    result.and(saved)
+}
+
+/// The operations needed to create the directories on the server, implemented for each protocol.
+pub(crate) trait RemoteDirectories {
+    /// Create given directory, its parent must exist.
+    fn mkdir(&mut self, path: &str) -> Result<(), Box<dyn Error>>;
+
+    /// Returns `true` if given directory exists.
+    fn directory_exist(&mut self, path: &str) -> Result<bool, Box<dyn Error>>;
+}
+
+/// Create the missing parent directories of given files on the server,
+/// once per directory instead of once per file.
+pub(crate) fn create_directories<D: RemoteDirectories>(
+    remote: &mut D,
+    existing_directories: &mut DirectoryCache,
+    remote_dir: &str,
+    files: &[String],
+) -> Result<(), Box<dyn Error>> {
+    for directory in parent_directories(files) {
+        make_directories(
+            remote,
+            existing_directories,
+            &remote_directory(remote_dir, directory),
+        )?;
+    }
+
+    Ok(())
+}
+
+/// Create given (normalized) directory and its missing parents.
+/// `existing_directories` is a cache of the directories known to exist.
+fn make_directories<D: RemoteDirectories>(
+    remote: &mut D,
+    existing_directories: &mut DirectoryCache,
+    directory: &str,
+) -> Result<(), Box<dyn Error>> {
+    // the root directory always exist
+    if directory.is_empty() || existing_directories.contains(directory) {
+        return Ok(());
+    }
+
+    // most of the time the parents already exist, so try to create the directory directly.
+    // if this fails, either the directory already exist or some parents are missing:
+    // walk up until an existing directory is found, then create the missing ones.
+    let directories: Vec<&str> = ancestors(directory).collect();
+    if remote.mkdir(directory).is_err() {
+        let mut existing = directories.len();
+        while existing > 0 {
+            let current_dir = directories[existing - 1];
+            if existing_directories.contains(current_dir) || remote.directory_exist(current_dir)? {
+                break;
+            }
+
+            existing -= 1;
+        }
+
+        for current_dir in &directories[existing..] {
+            remote.mkdir(current_dir)?;
+        }
+    }
+
+    // insert directories into cache
+    for current_dir in directories {
+        existing_directories.insert(current_dir);
+    }
+
+    Ok(())
+}
+
+/// Returns the unique parent directories of given files, sorted by depth
+/// (so that parents come before their children).
+pub(crate) fn parent_directories<'a, I: IntoIterator<Item = &'a String>>(files: I) -> Vec<&'a str> {
+    let directories: HashSet<&str> = files
+        .into_iter()
+        .map(|path| path.rsplit_once('/').map_or("", |(parent, _)| parent))
+        .collect();
+
+    let mut directories: Vec<&str> = directories.into_iter().collect();
+    // the root directory ("") comes first, then a, then a/b...
+    directories.sort_unstable_by_key(|directory| {
+        if directory.is_empty() {
+            0
+        } else {
+            directory.matches('/').count() + 1
+        }
+    });
+    directories
+}
+
+/// Returns the (normalized) path of given local directory on the server.
+pub(crate) fn remote_directory(remote_dir: &str, directory: &str) -> String {
+    normalize(&format!("{}/{}", remote_dir, directory))
+}
+
+/// Normalize given remote path so that it can be used as a cache key: /a/b/c
+pub(crate) fn normalize(path: &str) -> String {
+    let mut normalized = String::with_capacity(path.len() + 1);
+    for folder in path.split('/').filter(|f| !f.is_empty()) {
+        normalized.push('/');
+        normalized.push_str(folder);
+    }
+    normalized
+}
+
+/// Returns given (normalized) directory and all its parents, from the top-most one: /a, /a/b, /a/b/c
+pub(crate) fn ancestors(directory: &str) -> impl Iterator<Item = &str> {
+    directory
+        .match_indices('/')
+        .skip(1)
+        .map(move |(i, _)| &directory[..i])
+        .chain(iter::once(directory).filter(|d| !d.is_empty()))
+}
+
+/// Delete the given files by pipelining the DELE commands: they are all sent at once,
+/// then the responses are read back, instead of waiting a full round trip for each file.
+fn delete_files<'a>(
+    session: &mut FtpStream,
+    remote_dir: &str,
+    paths: &'a [String],
+    done: &dyn Fn(&'a String),
+) -> Result<(), ThreadError> {
+    let mut commands = String::new();
+    for path in paths {
+        commands += format!("DELE {}/{}\r\n", remote_dir, path).as_str();
+    }
+    session.get_ref().write_all(commands.as_bytes())?;
+
+    // read every response, even after a failure, so that the next command
+    // sent on this session (which goes back to the pool) is not answered by a stale response
+    let mut result = Ok(());
+    for path in paths {
+        match session.read_response(status::REQUESTED_FILE_ACTION_OK) {
+            Ok(_) => done(path),
+            // the connection is lost: there's nothing left to read
+            Err(e @ FtpError::ConnectionError(_)) => return Err(e.into()),
+            Err(e) => {
+                if result.is_ok() {
+                    result = Err(e.into());
+                }
+            }
+        }
+    }
+
+    result
+}
+
+/// Send a raw command and read back its response.
+/// Returns the response code and the content of a multi-line response
+/// (which is discarded by `FtpStream::read_response`).
+///
+/// The response is read straight from the control connection, bypassing the reader of `FtpStream`:
+/// this requires that reader to hold nothing, which is the case since it only reads whole responses
+/// and the server sends nothing past a response (unless it closes the connection).
+fn raw_command(session: &mut FtpStream, command: &str) -> Result<(u32, Vec<String>), FtpError> {
+    session
+        .get_ref()
+        .write_all(format!("{}\r\n", command).as_bytes())
+        .map_err(FtpError::ConnectionError)?;
+
+    let line = read_line(session.get_ref()).map_err(FtpError::ConnectionError)?;
+    let code = line
+        .get(0..3)
+        .and_then(|code| code.parse::<u32>().ok())
+        .ok_or_else(|| FtpError::InvalidResponse(format!("invalid response: {}", line)))?;
+
+    // multi-line response: read until the line beginning with the code and a space
+    let last_line = format!("{} ", code);
+    let mut lines = Vec::new();
+    if line.get(3..4) == Some("-") {
+        loop {
+            let line = read_line(session.get_ref()).map_err(FtpError::ConnectionError)?;
+            if line.is_empty() || line.starts_with(&last_line) {
+                break;
+            }
+            lines.push(line.trim_end().to_string());
+        }
+    }
+
+    Ok((code, lines))
+}
+
+/// Read a single line from the control connection (empty once the connection is closed).
+/// The line is read byte by byte so that nothing past it is consumed: whatever follows
+/// (another response) is left for the reader of `FtpStream`.
+/// The responses read this way are a few short lines, so this costs next to nothing.
+fn read_line(mut stream: &TcpStream) -> io::Result<String> {
+    let mut line = Vec::new();
+    let mut byte = [0; 1];
+    loop {
+        match stream.read(&mut byte) {
+            Ok(0) => break,
+            Ok(_) => {
+                line.push(byte[0]);
+                if byte[0] == b'\n' {
+                    break;
+                }
+            }
+            Err(e) if e.kind() == ErrorKind::Interrupted => continue,
+            Err(e) => return Err(e),
+        }
+    }
+
+    Ok(String::from_utf8_lossy(&line).into_owned())
+}
+
+/// Ask the server for the extensions it supports.
+fn features(session: &mut FtpStream) -> Result<HashSet<String>, FtpError> {
+    let (code, lines) = raw_command(session, "FEAT")?;
+
+    // the FEAT command itself may not be supported
+    if code != status::SYSTEM {
+        return Ok(HashSet::new());
     }
 
-    fn directory_exist(&mut self, haystack: &str, needle: &str) -> Result<bool, Box<dyn Error>> {
-        for f in self.ftp_session.as_mut().unwrap().list(Some(haystack))? {
-            let parts: Vec<&str> = f.split_whitespace().collect();
-            let perm = parts[0];
-            let name = parts[parts.len() - 1];
-            let is_dir = perm.starts_with('d');
+    Ok(lines
+        .iter()
+        .filter_map(|line| line.split_whitespace().next())
+        .map(|feature| feature.to_uppercase())
+        .collect())
+}
+
+#[cfg(test)]
+mod tests {
+    use std::cell::RefCell;
+    use std::collections::HashSet;
+    use std::error::Error;
+    use std::fs;
+    use std::io::{BufRead, BufReader, Write};
+    use std::net::TcpListener;
+    use std::sync::atomic::{AtomicUsize, Ordering};
+    use std::thread::{self, JoinHandle};
+
+    use ftp::FtpStream;
+    use indicatif::ProgressBar;
+    use tempdir::TempDir;
+
+    use crate::index::{Index, DIRECTORY_CACHE_FILE};
+    use crate::sync::{
+        ancestors, create_directories, delete_files, features, for_each_file, normalize, now,
+        parent_directories, raw_command, remote_directory, synchronize_files, DirectoryCache,
+        FtpDirectories, Pool, RemoteDirectories, Transfer, DIRECTORY_CACHE_TTL,
+    };
+
+    /// Start a fake FTP server which follows given script: each step is the number of commands
+    /// to read, then the reply to send back (at once).
+    /// Returns a session connected to it, and a handle returning the commands it has received.
+    fn fake_server(script: Vec<(usize, &'static str)>) -> (FtpStream, JoinHandle<Vec<String>>) {
+        let listener = TcpListener::bind("127.0.0.1:0").expect("unable to start fake server");
+        let address = listener
+            .local_addr()
+            .expect("unable to get fake server address");
 
-            if is_dir && name == needle {
-                return Ok(true);
+        let server = thread::spawn(move || {
+            let (mut stream, _) = listener.accept().expect("unable to accept connection");
+            let mut reader = BufReader::new(stream.try_clone().expect("unable to clone stream"));
+            stream
+                .write_all(b"220 ready\r\n")
+                .expect("unable to send greeting");
+
+            let mut commands = Vec::new();
+            for (count, reply) in script {
+                for _ in 0..count {
+                    let mut line = String::new();
+                    reader.read_line(&mut line).expect("unable to read command");
+                    commands.push(line.trim_end().to_string());
+                }
+                stream
+                    .write_all(reply.as_bytes())
+                    .expect("unable to send reply");
             }
+            commands
+        });
+
+        let session = FtpStream::connect(address).expect("unable to connect to fake server");
+        (session, server)
+    }
+
+    /// A server which only knows about its directories.
+    struct FakeDirectories {
+        directories: HashSet<String>,
+        requests: usize,
+    }
+
+    impl RemoteDirectories for FakeDirectories {
+        fn mkdir(&mut self, path: &str) -> Result<(), Box<dyn Error>> {
+            self.requests += 1;
+
+            let parent = &path[..path.rfind('/').unwrap_or(0)];
+            if self.directories.contains(path)
+                || !(parent.is_empty() || self.directories.contains(parent))
+            {
+                return Err("unable to create directory".into());
+            }
+
+            self.directories.insert(path.to_string());
+            Ok(())
         }
 
-        Ok(false)
+        fn directory_exist(&mut self, path: &str) -> Result<bool, Box<dyn Error>> {
+            self.requests += 1;
+            Ok(self.directories.contains(path))
+        }
+    }
+
+    /// A transfer which fails to upload the files.
+    struct FailingTransfer {
+        // the number of sessions opened, if any
+        sessions: Option<usize>,
+        existing_directories: DirectoryCache,
+    }
+
+    impl FailingTransfer {
+        fn new() -> FailingTransfer {
+            FailingTransfer {
+                sessions: None,
+                existing_directories: DirectoryCache::new("ftp://user@example.org:21/".to_string()),
+            }
+        }
+    }
+
+    impl Transfer for FailingTransfer {
+        fn parallel(&self) -> usize {
+            4
+        }
+
+        fn open(&mut self, size: usize) -> Result<usize, Box<dyn Error>> {
+            self.sessions = Some(size);
+            Ok(size)
+        }
+
+        fn remote_dir(&self) -> &str {
+            "/"
+        }
+
+        fn existing_directories(&mut self) -> &mut DirectoryCache {
+            &mut self.existing_directories
+        }
+
+        fn process_changed_files(
+            &mut self,
+            _progress_bar: &ProgressBar,
+            _current_index: &Index,
+            _previous_index: &mut Index,
+            _files: &[String],
+        ) -> Result<(), Box<dyn Error>> {
+            Err("unable to upload file".into())
+        }
+
+        fn process_deleted_files(
+            &mut self,
+            _progress_bar: &ProgressBar,
+            _previous_index: &mut Index,
+            _files: &[String],
+        ) -> Result<(), Box<dyn Error>> {
+            Ok(())
+        }
+    }
+
+    #[test]
+    fn test_parent_directories() {
+        let files: Vec<String> = vec!["a/b/c/file", "a/file", "file", "a/b/file", "d/file"]
+            .into_iter()
+            .map(String::from)
+            .collect();
+
+        let directories = parent_directories(&files);
+        assert_eq!(directories.len(), 5);
+
+        // top-level files map to the root directory
+        assert!(directories.contains(&""));
+
+        // the parents come before their children
+        let position = |d| directories.iter().position(|&x| x == d).unwrap();
+        assert!(position("") < position("a"));
+        assert!(position("a") < position("a/b"));
+        assert!(position("a/b") < position("a/b/c"));
+    }
+
+    #[test]
+    fn test_normalize() {
+        assert_eq!(normalize(""), "");
+        assert_eq!(normalize("/"), "");
+        assert_eq!(normalize("//a/b/"), "/a/b");
+        assert_eq!(normalize("a//b"), "/a/b");
+    }
+
+    #[test]
+    fn test_remote_directory() {
+        assert_eq!(remote_directory("/", "a"), "/a");
+        assert_eq!(remote_directory("/", ""), "");
+        assert_eq!(remote_directory("/x", "a/b"), "/x/a/b");
+        assert_eq!(remote_directory("/x", ""), "/x");
+        assert_eq!(remote_directory("/x/", "a"), "/x/a");
+    }
+
+    #[test]
+    fn test_ancestors() {
+        assert_eq!(ancestors("").count(), 0);
+        assert_eq!(ancestors("/a").collect::<Vec<&str>>(), vec!["/a"]);
+        assert_eq!(ancestors("/a/b").collect::<Vec<&str>>(), vec!["/a", "/a/b"]);
+    }
+
+    #[test]
+    fn test_create_directories() {
+        let mut remote = FakeDirectories {
+            directories: vec!["/www".to_string()].into_iter().collect(),
+            requests: 0,
+        };
+        let mut cache = DirectoryCache::new("ftp://user@example.org:21/".to_string());
+        let files = vec![
+            "a.txt".to_string(),
+            "b/c/d.txt".to_string(),
+            "b/c/e.txt".to_string(),
+            "b/f.txt".to_string(),
+        ];
+
+        create_directories(&mut remote, &mut cache, "/www/", &files)
+            .expect("unable to create directories");
+
+        let mut directories: Vec<&String> = remote.directories.iter().collect();
+        directories.sort();
+        assert_eq!(directories, vec!["/www", "/www/b", "/www/b/c"]);
+        assert!(cache.contains("/www"));
+        assert!(cache.contains("/www/b/c"));
+
+        // everything is cached now, nothing should be sent to the server
+        let requests = remote.requests;
+        create_directories(&mut remote, &mut cache, "/www", &files)
+            .expect("unable to create directories");
+        assert_eq!(remote.requests, requests);
+    }
+
+    #[test]
+    fn test_directory_cache() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        let mut cache = DirectoryCache::new("ftp://user@example.org:21/".to_string());
+        cache.insert("/a");
+        cache.insert("/a/b:c");
+        cache.save(dir.path()).expect("unable to save cache");
+
+        let mut cache = DirectoryCache::new("ftp://user@example.org:21/".to_string());
+        cache.load(dir.path());
+        assert!(cache.contains("/a"));
+        assert!(cache.contains("/a/b:c"));
+        assert!(!cache.contains("/b"));
+
+        // the cache is not used against another destination
+        let mut cache = DirectoryCache::new("ftp://user@example.com:21/".to_string());
+        cache.load(dir.path());
+        assert!(!cache.contains("/a"));
+    }
+
+    #[test]
+    fn test_directory_cache_expired() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        fs::write(
+            dir.path().join(DIRECTORY_CACHE_FILE),
+            format!(
+                "ftp://user@example.org:21/\n{}:/a\n{}:/b\n",
+                now(),
+                now() - DIRECTORY_CACHE_TTL - 1
+            ),
+        )
+        .expect("unable to write cache");
+
+        let mut cache = DirectoryCache::new("ftp://user@example.org:21/".to_string());
+        cache.load(dir.path());
+        assert!(cache.contains("/a"));
+        assert!(!cache.contains("/b"));
+    }
+
+    #[test]
+    fn test_synchronize_files_failed() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        fs::write(dir.path().join("test"), "hello").expect("unable to write test file");
+
+        let mut cache = DirectoryCache::new("ftp://user@example.org:21/".to_string());
+        cache.insert("/a");
+        cache.save(dir.path()).expect("unable to save cache");
+
+        let mut previous_index = Index::load(&dir).expect("unable to load index");
+        let (current_index, _) =
+            Index::compute(&dir, &previous_index).expect("unable to compute index");
+
+        let mut transfer = FailingTransfer::new();
+        assert!(synchronize_files(
+            Some(&mut transfer),
+            &current_index,
+            &mut previous_index,
+            false
+        )
+        .is_err());
+
+        // no need to open more sessions than there are files
+        assert_eq!(transfer.sessions, Some(1));
+
+        // the cached directories are forgotten, in case one of them is the cause
+        let mut cache = DirectoryCache::new("ftp://user@example.org:21/".to_string());
+        cache.load(dir.path());
+        assert!(!cache.contains("/a"));
+    }
+
+    #[test]
+    fn test_synchronize_files_nothing_to_transfer() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        let mut previous_index = Index::load(&dir).expect("unable to load index");
+        let (current_index, _) =
+            Index::compute(&dir, &previous_index).expect("unable to compute index");
+
+        let mut transfer = FailingTransfer::new();
+        synchronize_files(
+            Some(&mut transfer),
+            &current_index,
+            &mut previous_index,
+            false,
+        )
+        .expect("unable to synchronize files");
+
+        // the server is not even connected to
+        assert_eq!(transfer.sessions, None);
+    }
+
+    #[test]
+    fn test_features() {
+        let (mut session, server) = fake_server(vec![
+            (
+                1,
+                "211-Features:\r\n MLST type*;size*;modify*;\r\n utf8\r\n211 End\r\n",
+            ),
+            (1, "500 Unknown command\r\n"),
+        ]);
+
+        let supported = features(&mut session).expect("unable to get features");
+        assert_eq!(supported.len(), 2);
+        assert!(supported.contains("MLST"));
+        assert!(supported.contains("UTF8"));
+
+        // the FEAT command is not supported
+        let supported = features(&mut session).expect("unable to get features");
+        assert!(supported.is_empty());
+
+        assert_eq!(server.join().unwrap(), vec!["FEAT", "FEAT"]);
+    }
+
+    #[test]
+    fn test_raw_command_following_response() {
+        // the server closes the connection right after answering
+        let (mut session, server) = fake_server(vec![(1, "250 OK\r\n421 Timeout\r\n")]);
+
+        let (code, lines) = raw_command(&mut session, "CWD /a").expect("unable to send command");
+        assert_eq!(code, 250);
+        assert!(lines.is_empty());
+
+        // what follows the response is not lost
+        session
+            .read_response(421)
+            .expect("the following response has been lost");
+
+        assert_eq!(server.join().unwrap(), vec!["CWD /a"]);
+    }
+
+    #[test]
+    fn test_directory_exist() {
+        let (mut session, server) = fake_server(vec![
+            (
+                1,
+                "250-Listing /a\r\n Type=dir;Modify=20210101000000; /a\r\n250 End\r\n",
+            ),
+            (1, "250-Listing /b\r\n type=file;size=5; /b\r\n250 End\r\n"),
+            (1, "550 Not found\r\n"),
+            (1, "250 OK\r\n"),
+            (1, "550 Not found\r\n"),
+        ]);
+
+        let mut directories = FtpDirectories {
+            session: &mut session,
+            use_mlst: true,
+        };
+        assert!(directories.directory_exist("/a").unwrap());
+        assert!(!directories.directory_exist("/b").unwrap());
+        assert!(!directories.directory_exist("/c").unwrap());
+
+        // without MLST, the directories are entered
+        directories.use_mlst = false;
+        assert!(directories.directory_exist("/a").unwrap());
+        assert!(!directories.directory_exist("/c").unwrap());
+
+        assert_eq!(
+            server.join().unwrap(),
+            vec!["MLST /a", "MLST /b", "MLST /c", "CWD /a", "CWD /c"]
+        );
+    }
+
+    #[test]
+    fn test_delete_files() {
+        let (mut session, server) = fake_server(vec![
+            (
+                4,
+                "250 Deleted\r\n550 Not found\r\n250 Deleted\r\n450 Busy\r\n",
+            ),
+            (1, "200 OK\r\n"),
+        ]);
+
+        let paths: Vec<String> = vec!["a", "b", "c", "d"]
+            .into_iter()
+            .map(String::from)
+            .collect();
+        let deleted = RefCell::new(Vec::new());
+        let result = delete_files(&mut session, "/www", &paths, &|path| {
+            deleted.borrow_mut().push(path.as_str())
+        });
+
+        // the files deleted before and after the failure are reported, along with the first error
+        assert_eq!(*deleted.borrow(), vec!["a", "c"]);
+        let error = result
+            .expect_err("the failure has not been reported")
+            .to_string();
+        assert!(error.contains("550"));
+
+        // every response has been read: the session is still usable
+        let (code, _) = raw_command(&mut session, "NOOP").expect("unable to send command");
+        assert_eq!(code, 200);
+
+        assert_eq!(
+            server.join().unwrap(),
+            vec![
+                "DELE /www/a",
+                "DELE /www/b",
+                "DELE /www/c",
+                "DELE /www/d",
+                "NOOP"
+            ]
+        );
+    }
+
+    #[test]
+    fn test_for_each_file_failed() {
+        let dir = TempDir::new("osync").expect("unable to create temp dir");
+
+        // the index cannot be saved either: its directory does not exist
+        let mut index = Index::load(dir.path().join("missing")).expect("unable to load index");
+        let pool = Pool::open(2, || Ok::<(), &str>(())).expect("unable to open pool");
+        let files = vec!["a".to_string(), "b".to_string()];
+
+        let result = for_each_file(
+            &pool,
+            &mut index,
+            &files,
+            1,
+            |_, _, _| Err("unable to upload file".into()),
+            |_, _| Ok(()),
+        );
+        assert_eq!(
+            result
+                .expect_err("the failure has not been reported")
+                .to_string(),
+            "unable to upload file"
+        );
+    }
+
+    #[test]
+    fn test_pool_open_partially() {
+        // the server only accepts two connections
+        let connections = AtomicUsize::new(0);
+        let pool = Pool::open(4, || {
+            if connections.fetch_add(1, Ordering::SeqCst) < 2 {
+                Ok(())
+            } else {
+                Err("too many connections")
+            }
+        })
+        .expect("unable to open pool");
+        assert_eq!(pool.size, 2);
+
+        let pool: Result<Pool<()>, _> = Pool::open(4, || Err("connection refused"));
+        assert!(pool.is_err());
     }
 }